@@ -23,13 +23,37 @@ __license__ = "MIT"
 
 
 import argparse
+import csv
 import json
 import os
 import re
+import shutil
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 import cv2
+import numpy as np
+from tqdm import tqdm
+
+# Parallelism comes from the process pool in `main`, keep OpenCV single-threaded
+# in each worker to avoid oversubscribing the CPUs.
+cv2.setNumThreads(1)
+
+# Binary label masks compress almost as well at level 1 with RLE as at the
+# default level, at a fraction of the CPU cost. Labels are kept as 8-bit
+# grayscale rather than 1-bit PNGs: decoders expand 1-bit data to 0/255,
+# whereas nnUNetv2 expects the label values 0/1 declared in dataset.json.
+LABEL_PNG_PARAMS = [
+    cv2.IMWRITE_PNG_COMPRESSION,
+    1,
+    cv2.IMWRITE_PNG_STRATEGY,
+    cv2.IMWRITE_PNG_STRATEGY_RLE,
+]
+IMAGE_PNG_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+
+_SAMPLE_RE = re.compile(r"(sub-nyuMouse\d+)_.*(sample-\d+)")
 
 
 def extract_sample_participant(s: str) -> tuple:
@@ -53,7 +77,7 @@ def extract_sample_participant(s: str) -> tuple:
     ValueError
         If the string does not contain the expected pattern.
     """
-    match = re.search(r"(sub-nyuMouse\d+)_.*(sample-\d+)", s)
+    match = _SAMPLE_RE.search(s)
     if not match:
         raise ValueError("The string does not contain the expected pattern.")
     return match.groups()
@@ -85,97 +109,224 @@ def save_json(data: Dict, file_path: str):
     file_path : str
         File path where the JSON file will be saved.
     """
-    with open(file_path, "w") as f:
-        json.dump(data, f, indent=2)
+    with open(file_path, "w", buffering=1 << 20) as f:
+        f.write(json.dumps(data, indent=2))
+
+
+def _index_dataset(datapath: Path) -> Dict[str, Dict[str, List[str]]]:
+    """
+    Indexes the subjects and PNG files of a BIDS dataset with a single directory walk.
+
+    Parameters
+    ----------
+    datapath : Path
+        Path to the data directory.
+
+    Returns
+    -------
+    Dict[str, Dict[str, List[str]]]
+        Dictionary with the keys "images" (subjects found in datapath), "labels"
+        (subjects found in derivatives/labels) and "ads-derivatives" (subjects
+        found in derivatives/ads-derivatives). Each value maps a subject name
+        to the sorted paths of the PNG files in its "micr" directory.
+    """
+    index = {"images": {}, "labels": {}, "ads-derivatives": {}}
+    # Symlinked subject and micr folders are followed, as Path.glob did; the
+    # pruning below keeps the walk to a fixed depth
+    for dirpath, dirnames, filenames in os.walk(datapath, followlinks=True):
+        parts = Path(dirpath).relative_to(datapath).parts
+        if not parts:
+            subjects = [d for d in dirnames if d.startswith("sub")]
+            index["images"].update((d, []) for d in subjects)
+            dirnames[:] = subjects + (["derivatives"] if "derivatives" in dirnames else [])
+        elif parts == ("derivatives",):
+            dirnames[:] = [d for d in dirnames if d in ("labels", "ads-derivatives")]
+        elif len(parts) == 2 and parts[0] == "derivatives":
+            subjects = [d for d in dirnames if d.startswith("sub")]
+            index[parts[1]].update((d, []) for d in subjects)
+            # Only the subject names are needed for the ADS derivatives
+            dirnames[:] = [] if parts[1] == "ads-derivatives" else subjects
+        elif parts[-1] == "micr":
+            table = index["labels"] if parts[0] == "derivatives" else index["images"]
+            table[parts[-2]] = sorted(
+                os.path.join(dirpath, f) for f in filenames if f.endswith(".png")
+            )
+            dirnames[:] = []
+        else:
+            # Subject directory: only the "micr" folder holds PNGs
+            dirnames[:] = [d for d in dirnames if d == "micr"]
+    return index
+
+
+def _is_8bit_grayscale_png(path: str) -> bool:
+    """
+    Checks whether a PNG file is stored as 8-bit single-channel grayscale by reading its IHDR chunk.
+
+    Parameters
+    ----------
+    path : str
+        Path to the PNG file.
+
+    Returns
+    -------
+    bool
+        True if the file is an 8-bit grayscale PNG, False otherwise.
+    """
+    with open(path, "rb") as f:
+        header = f.read(26)
+    # 8-byte signature, then the IHDR chunk: length (4), type (4), width (4),
+    # height (4), bit depth (1) and color type (1)
+    if len(header) < 26 or header[12:16] != b"IHDR":
+        return False
+    bit_depth, color_type = header[24], header[25]
+    return bit_depth == 8 and color_type == 0
+
+
+def _write_png(dst_path: str, img: np.ndarray, params: List[int]):
+    """
+    Encodes an image as PNG in memory and writes it with a single buffered write.
+
+    Parameters
+    ----------
+    dst_path : str
+        Path to the destination file.
+    img : np.ndarray
+        Image to encode.
+    params : List[int]
+        Encoding parameters passed to `cv2.imencode`.
+    """
+    ok, buf = cv2.imencode(".png", img, params)
+    if not ok:
+        raise OSError(f"Could not encode {dst_path} as PNG.")
+    with open(dst_path, "wb", buffering=1 << 20) as f:
+        f.write(buf)
+
+
+def _convert_one(args: Tuple[str, str, bool]):
+    """
+    Converts a single image or label file to the nnUNetv2 format.
+
+    Parameters
+    ----------
+    args : Tuple[str, str, bool]
+        A tuple (src_path, dst_path, is_label). Label files are binarized
+        (255 -> 1) before being written to dst_path. Images that are already
+        8-bit grayscale PNGs are copied verbatim instead of being re-encoded.
+    """
+    src_path, dst_path, is_label = args
+    if not is_label and _is_8bit_grayscale_png(src_path):
+        shutil.copyfile(src_path, dst_path)
+        return
+    if is_label:
+        label = cv2.imdecode(np.fromfile(src_path, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        # Equivalent to `label // 255` on uint8 data, thresholded in place
+        np.equal(label, 255, out=label)
+        _write_png(dst_path, label, LABEL_PNG_PARAMS)
+    else:
+        img = cv2.imread(src_path, cv2.IMREAD_GRAYSCALE)
+        _write_png(dst_path, img, IMAGE_PNG_PARAMS)
 
 
 def process_images(
     subject_list: List[str],
-    datapath: Path,
+    image_index: Dict[str, List[str]],
     out_folder: str,
-    case_id_dict: Dict[str, int],
+    case_id_dict: Dict[Tuple[str, str], int],
     dataset_name: str,
     is_test: bool = False,
-):
+) -> List[Tuple[str, str, bool]]:
     """
-    Processes all image files in each subject's directory.
+    Lists all image files in each subject's directory and their destination in the nnUNetv2 dataset.
 
     Parameters
     ----------
     subject_list : List[str]
         List of subjects whose images are to be processed.
-    datapath : Path
-        Path to the data directory.
+    image_index : Dict[str, List[str]]
+        Dictionary mapping subject names to the paths of their images, as returned by `_index_dataset`.
     out_folder : str
         Output directory to save processed images.
-    case_id_dict : Dict[str, int]
-        Dictionary mapping subject names to case IDs.
+    case_id_dict : Dict[Tuple[str, str], int]
+        Dictionary mapping (participant_id, sample_id) tuples to case IDs.
     dataset_name : str
         Name of the dataset.
     is_test : bool, optional
         Boolean flag indicating if the images are for testing, by default False.
+
+    Returns
+    -------
+    List[Tuple[str, str, bool]]
+        List of (src_path, dst_path, is_label) tasks to be run by `_convert_one`.
     """
     folder_type = "imagesTs" if is_test else "imagesTr"
     image_suffix = "_0000"
+    dst_prefix = os.path.join(out_folder, folder_type, dataset_name)
+    tasks = []
     for subject in subject_list:
-        image_files = sorted(Path(datapath, subject, "micr").glob("*.png"))
-        for img_file in image_files:
-            key = str(extract_sample_participant(os.path.basename(img_file)))
+        for img_file in image_index.get(subject, []):
+            key = extract_sample_participant(os.path.basename(img_file))
             case_id = case_id_dict[key]
-            img = cv2.imread(str(img_file), cv2.IMREAD_GRAYSCALE)
-            fname = f"{dataset_name}_{case_id:03d}{image_suffix}.png"
-            cv2.imwrite(os.path.join(out_folder, folder_type, fname), img)
+            tasks.append((img_file, f"{dst_prefix}_{case_id:03d}{image_suffix}.png", False))
+    return tasks
 
 
 def process_labels(
     subject_list: List[str],
-    datapath: Path,
+    label_index: Dict[str, List[str]],
     out_folder: str,
-    case_id_dict: Dict[str, int],
+    case_id_dict: Dict[Tuple[str, str], int],
     dataset_name: str,
-):
+) -> List[Tuple[str, str, bool]]:
     """
-    Processes label images from a list of subjects, matching each image with the label having the largest 'N' number.
+    Lists label images from a list of subjects, matching each image with the label having the largest 'N' number.
 
     Parameters
     ----------
     subject_list : List[str]
         List of subjects whose label images are to be processed.
-    datapath : Path
-        Path to the data directory.
+    label_index : Dict[str, List[str]]
+        Dictionary mapping subject names to the paths of their label images, as returned by `_index_dataset`.
     out_folder : str
         Output directory to save processed label images.
-    case_id_dict : Dict[str, int]
-        Dictionary mapping subject names to case IDs.
+    case_id_dict : Dict[Tuple[str, str], int]
+        Dictionary mapping (participant_id, sample_id) tuples to case IDs.
     dataset_name : str
         Name of the dataset.
+
+    Returns
+    -------
+    List[Tuple[str, str, bool]]
+        List of (src_path, dst_path, is_label) tasks to be run by `_convert_one`.
     """
+    dst_prefix = os.path.join(out_folder, "labelsTr", dataset_name)
+    tasks = []
     for subject in subject_list:
-        label_files = []
-        image_files = sorted(
-            Path(datapath, "derivatives", "labels", subject, "micr").glob("*.png")
-        )
-        for img_file in image_files:
-            sample = os.path.basename(img_file).split("_")[1]
-            label_files_match = sorted(
-                Path(datapath, "derivatives", "labels", subject, "micr").glob(
-                    f"{subject}_{sample}_axonmyelin_seg-touching*-manual.png"
-                )
-            )
-            if label_files_match:
-                label_files.append(label_files_match[-1])
+        by_sample: Dict[str, List[str]] = defaultdict(list)
+        for label_path in label_index.get(subject, []):
+            name = os.path.basename(label_path)
+            if not name.endswith("-manual.png"):
+                continue
+            parts = name.split("_")
+            if len(parts) < 3:
+                continue
+            sample = parts[1]
+            if name.startswith(f"{subject}_{sample}_axonmyelin_seg-touching"):
+                by_sample[sample].append(label_path)
+        # Paths are sorted, so the last match of each sample has the largest 'N'
+        label_files = [by_sample[sample][-1] for sample in sorted(by_sample)]
 
         for label_file in label_files:
-            key = str(extract_sample_participant(os.path.basename(label_file)))
+            key = extract_sample_participant(os.path.basename(label_file))
             case_id = case_id_dict[key]
-            label = cv2.imread(str(label_file), cv2.IMREAD_GRAYSCALE) // 255
-            fname = f"{dataset_name}_{case_id:03d}.png"
-            cv2.imwrite(os.path.join(out_folder, "labelsTr", fname), label)
+            tasks.append((label_file, f"{dst_prefix}_{case_id:03d}.png", True))
+    return tasks
 
 
-def create_case_id_dict(subject_list: List[str], datapath: Path) -> Dict[str, int]:
+def create_case_id_dict(
+    subject_list: List[str], datapath: Path
+) -> Dict[Tuple[str, str], int]:
     """
-    Creates a dictionary mapping unique (sample_id, participant_id) tuples to case IDs.
+    Creates a dictionary mapping unique (participant_id, sample_id) tuples to case IDs.
 
     Parameters
     ----------
@@ -186,20 +337,20 @@ def create_case_id_dict(subject_list: List[str], datapath: Path) -> Dict[str, in
 
     Returns
     -------
-    Dict[str, int]
-        Dictionary mapping unique (sample_id, participant_id) tuples to case IDs.
+    Dict[Tuple[str, str], int]
+        Dictionary mapping unique (participant_id, sample_id) tuples to case IDs.
     """
     case_id_dict = {}
     case_id = 0
+    subject_set = frozenset(subject_list)
     samples_file = datapath / "samples.tsv"
-    with open(samples_file, "r") as f:
+    with open(samples_file, "r", newline="") as f:
+        reader = csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE)
         # Skip header line
-        next(f)
-        for line in f:
-            parts = line.strip().split("\t")
-            sample_id, participant_id = parts[0], parts[1]
-            key = str((participant_id, sample_id))
-            if participant_id in subject_list:
+        next(reader)
+        for sample_id, participant_id, *_ in reader:
+            key = (participant_id, sample_id)
+            if participant_id in subject_set:
                 if key not in case_id_dict:
                     case_id_dict[key] = case_id
                     case_id += 1
@@ -213,7 +364,7 @@ def main(args):
     Parameters
     ----------
     args : argparse.Namespace
-        Command line arguments containing DATAPATH and TARGETDIR.
+        Command line arguments containing DATAPATH, TARGETDIR and NUM_WORKERS.
     """
     dataset_name = args.DATASETNAME
     description = args.DESCRIPTION
@@ -221,11 +372,10 @@ def main(args):
     target_dir = Path(args.TARGETDIR)
     dataset_num = args.NUM
     
-    names = list(Path(datapath).glob("sub*"))
-    subject_list = [d.name for d in names]
-    derivatives = list(Path(datapath, "derivatives", "labels").glob("sub*"))
-    train_subject_list = [d.name for d in derivatives]
-    test_subject_list = [d.name for d in names if d.name not in train_subject_list]
+    index = _index_dataset(datapath)
+    subject_list = sorted(index["images"])
+    train_subject_list = sorted(index["labels"])
+    test_subject_list = [d for d in subject_list if d not in index["labels"]]
 
     out_folder = os.path.join(target_dir, "nnUNet_raw", f"Dataset{dataset_num:03d}_{dataset_name}")
     create_directories(out_folder, ["imagesTr", "labelsTr", "imagesTs"])
@@ -243,24 +393,39 @@ def main(args):
     }
     save_json(dataset_info, os.path.join(out_folder, "dataset.json"))
 
-    process_images(train_subject_list, datapath, out_folder, case_id_dict, dataset_name)
-    process_labels(train_subject_list, datapath, out_folder, case_id_dict, dataset_name)
+    tasks = process_images(train_subject_list, index["images"], out_folder, case_id_dict, dataset_name)
+    tasks += process_labels(train_subject_list, index["labels"], out_folder, case_id_dict, dataset_name)
     
-    process_images(test_subject_list, datapath, out_folder, case_id_dict, dataset_name, is_test=True)
+    tasks += process_images(test_subject_list, index["images"], out_folder, case_id_dict, dataset_name, is_test=True)
 
-    unannotated_subjects = [
-        d.name for d in Path(datapath, "derivatives", "ads-derivatives").glob("sub*")
-    ]
-    process_images(
+    unannotated_subjects = sorted(index["ads-derivatives"])
+    tasks += process_images(
         unannotated_subjects,
-        datapath,
+        index["images"],
         out_folder,
         case_id_dict,
         dataset_name,
         is_test=True,
     )
-
-    save_json(case_id_dict, os.path.join(target_dir, "subject_to_case_identifier.json"))
+    # Subjects without labels can also be listed in the ADS derivatives, drop
+    # the repeated tasks so no two workers write the same file
+    tasks = list(dict.fromkeys(tasks))
+
+    with ProcessPoolExecutor(max_workers=args.NUM_WORKERS) as executor:
+        # Consume the iterator so that worker exceptions are raised here
+        for _ in tqdm(
+            executor.map(_convert_one, tasks, chunksize=8),
+            total=len(tasks),
+            desc="Converting",
+            unit="file",
+        ):
+            pass
+
+    # JSON keys must be strings, keep the historical "('sub-...', 'sample-...')" format
+    save_json(
+        {str(key): case_id for key, case_id in case_id_dict.items()},
+        os.path.join(target_dir, "subject_to_case_identifier.json"),
+    )
 
 
 if __name__ == "__main__":
@@ -287,5 +452,11 @@ if __name__ == "__main__":
         default="Myelin boundary segmentation dataset for nnUNetv2",
         help="Description of the new dataset, defaults to Myelin boundary segmentation dataset for nnUNetv2",
     )
+    parser.add_argument(
+        "--NUM_WORKERS",
+        default=os.cpu_count(),
+        type=int,
+        help="Number of worker processes used to convert the files, defaults to the number of CPUs",
+    )
     args = parser.parse_args()
     main(args)
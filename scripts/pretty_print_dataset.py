@@ -1,5 +1,41 @@
 import argparse
 import os
+import sys
+from typing import List
+
+
+def _collect_directory_lines(rootdir: str, prefix: str, lines: List[str]) -> None:
+    """
+    Recursively collects the lines of the pretty-printed directory structure.
+
+    Parameters
+    ----------
+    rootdir : str
+        The root directory from which to collect the structure.
+    prefix : str
+        The prefix used for formatting the directory structure.
+    lines : List[str]
+        The list to which the formatted lines are appended.
+
+    Returns
+    -------
+    None
+    """
+    with os.scandir(rootdir) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    last_idx = len(entries) - 1
+    child_indent = prefix + "│   "
+    last_child_indent = prefix + "    "
+    branch = prefix + "├── "
+    last_branch = prefix + "└── "
+    for index, entry in enumerate(entries):
+        is_last = index == last_idx
+        lines.append(f"{last_branch if is_last else branch}{entry.name}")
+        if entry.is_dir(follow_symlinks=False):
+            # Directory case: recursively collect its contents with an updated prefix
+            _collect_directory_lines(
+                entry.path, last_child_indent if is_last else child_indent, lines
+            )
 
 
 def print_directory_structure(rootdir: str, prefix: str = "") -> None:
@@ -17,19 +53,10 @@ def print_directory_structure(rootdir: str, prefix: str = "") -> None:
     -------
     None
     """
-    files = os.listdir(rootdir)
-    for index, file in enumerate(sorted(files)):
-        path = os.path.join(rootdir, file)
-        if os.path.isdir(path):
-            # Directory case: recursively print its contents with an updated prefix
-            new_prefix = prefix + "│   " if index < len(files) - 1 else prefix + "    "
-            connector = "├── " if index < len(files) - 1 else "└── "
-            print(f"{prefix}{connector}{file}")
-            print_directory_structure(path, new_prefix)
-        else:
-            # File case: just print the file name
-            connector = "├── " if index < len(files) - 1 else "└── "
-            print(f"{prefix}{connector}{file}")
+    lines = []
+    _collect_directory_lines(rootdir, prefix, lines)
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
 
 
 if __name__ == "__main__":